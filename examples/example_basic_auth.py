@@ -8,9 +8,9 @@ import picoweb
 
 app = picoweb.WebApp(__name__)
 
-@app.route("/")
+@app.route("/", headers="parse")
 def index(req, resp):
-    if b"Authorization" not in req.headers:
+    if b"authorization" not in req.headers:
         yield from resp.awrite(
             'HTTP/1.0 401 NA\r\n'
             'WWW-Authenticate: Basic realm="Picoweb Realm"\r\n'
@@ -18,7 +18,7 @@ def index(req, resp):
         )
         return
 
-    auth = req.headers[b"Authorization"].split(None, 1)[1]
+    auth = req.headers[b"authorization"].split(None, 1)[1]
     auth = ubinascii.a2b_base64(auth).decode()
     username, passwd = auth.split(":", 1)
     yield from picoweb.start_response(resp)
@@ -15,7 +15,8 @@ app = picoweb.WebApp(__name__)
 def require_auth(func):
 
     def auth(req, resp):
-        auth = req.headers.get(b"Authorization")
+        headers = yield from req.parse_headers()
+        auth = headers.get(b"authorization")
         if not auth:
             yield from resp.awrite(
                 'HTTP/1.0 401 NA\r\n'
@@ -32,12 +32,12 @@ def index(req, resp):
 # Send gzipped content if supported by client.
 # Shows specifying headers as a flat binary string -
 # more efficient if such headers are static.
-@app.route(re.compile('^\/(.+\.css)$'))
+@app.route(re.compile('^\/(.+\.css)$'), headers="parse")
 def styles(req, resp):
     file_path = req.url_match.group(1)
     headers = b"Cache-Control: max-age=86400\r\n"
 
-    if b"gzip" in req.headers.get(b"Accept-Encoding", b""):
+    if b"gzip" in req.headers.get(b"accept-encoding", b""):
         file_path += ".gz"
         headers += b"Content-Encoding: gzip\r\n"
 
@@ -12,6 +12,7 @@ def index(req, resp):
     yield from resp.awrite('<li><a href="mode_parse">header_mode="parse"</a>')
     yield from resp.awrite('<li><a href="mode_skip">header_mode="skip"</a>')
     yield from resp.awrite('<li><a href="mode_leave">header_mode="leave"</a>')
+    yield from resp.awrite('<li><a href="mode_lazy">header_mode="lazy"</a> (default)')
 
 
 def headers_parse(req, resp):
@@ -23,12 +24,12 @@ def headers_parse(req, resp):
 
 def headers_skip(req, resp):
     yield from picoweb.start_response(resp)
-    assert not hasattr(req, "headers")
+    assert req.headers is None
     yield from resp.awrite("No <tt>req.headers</tt>.")
 
 def headers_leave(req, resp):
     yield from picoweb.start_response(resp)
-    assert not hasattr(req, "headers")
+    assert req.headers is None
     yield from resp.awrite("Reading headers directly from input request:")
     yield from resp.awrite("<pre>")
     while True:
@@ -38,12 +39,21 @@ def headers_leave(req, resp):
         yield from resp.awrite(l)
     yield from resp.awrite("</pre>")
 
+def headers_lazy(req, resp):
+    # Headers are left unread until asked for, and skipped after the
+    # handler returns if it never did.
+    assert req.headers is None
+    headers = yield from req.parse_headers()
+    yield from picoweb.start_response(resp)
+    yield from resp.awrite("Parsed on demand: %d headers." % len(headers))
+
 
 ROUTES = [
     ("/", index),
     ("/mode_parse", headers_parse, {"headers": "parse"}),
     ("/mode_skip", headers_skip, {"headers": "skip"}),
     ("/mode_leave", headers_leave, {"headers": "leave"}),
+    ("/mode_lazy", headers_lazy, {"headers": "lazy"}),
 ]
 
 
@@ -11,199 +11,479 @@ import errno
 import asyncio
 import pkg_resources
 
+# Hex digit value by byte, for percent-decoding without int(x, 16);
+# 0xff marks bytes which aren't hex digits
+_HEX = bytearray(b"\xff" * 256)
+for _i in range(10):
+    _HEX[0x30 + _i] = _i
+for _i in range(6):
+    _HEX[0x41 + _i] = _HEX[0x61 + _i] = 10 + _i
+del _i
+
+def _unquote_bytes(buf, i=0, end=None):
+    if end is None:
+        end = len(buf)
+    if buf.find(b"+", i, end) >= 0:
+        buf = buf[i:end].replace(b"+", b" ")
+        i = 0
+        end = len(buf)
+    out = bytearray(end - i)
+    j = 0
+    while i < end:
+        p = buf.find(b"%", i, end)
+        if p < 0 or p + 2 >= end:
+            p = end
+        n = p - i
+        out[j:j + n] = buf[i:p]
+        j += n
+        if p == end:
+            break
+        hi = _HEX[buf[p + 1]]
+        lo = _HEX[buf[p + 2]]
+        if hi > 15 or lo > 15:
+            # Not an escape, keep the "%" as is
+            out[j] = 0x25
+            j += 1
+            i = p + 1
+            continue
+        out[j] = (hi << 4) | lo
+        j += 1
+        i = p + 3
+    return _decode(bytes(out[:j]))
+
+def _decode(b):
+    try:
+        return b.decode()
+    except UnicodeError:
+        # Not UTF-8, map each byte to the character with that code
+        return "".join([chr(c) for c in b])
+
 def unquote_plus(s):
-    s = s.replace("+", " ")
-    arr = s.split("%")
-    arr2 = [chr(int(x[:2], 16)) + x[2:] for x in arr[1:]]
-    return arr[0] + "".join(arr2)
+    if "%" not in s:
+        return s.replace("+", " ") if "+" in s else s
+    return _unquote_bytes(s.encode())
 
-def parse_qs(s):
+def _parse_qs_bytes(buf):
     res = {}
-    if s:
-        pairs = s.split("&")
-        for p in pairs:
-            vals = [unquote_plus(x) for x in p.split("=", 1)]
-            if len(vals) == 1:
-                vals.append(True)
-            old = res.get(vals[0])
-            if old is not None:
-                if not isinstance(old, list):
-                    old = [old]
-                    res[vals[0]] = old
-                old.append(vals[1])
+    n = len(buf)
+    plain = b"%" not in buf and b"+" not in buf
+    i = 0
+    while i < n:
+        amp = buf.find(b"&", i)
+        if amp < 0:
+            amp = n
+        eq = buf.find(b"=", i, amp)
+        if eq < 0:
+            k_end = amp
+        else:
+            k_end = eq
+        if plain:
+            k = _decode(buf[i:k_end])
+        else:
+            k = _unquote_bytes(buf, i, k_end)
+        if eq < 0:
+            v = True
+        elif plain:
+            v = _decode(buf[eq + 1:amp])
+        else:
+            v = _unquote_bytes(buf, eq + 1, amp)
+        if k in res:
+            old = res[k]
+            if type(old) is list:
+                old.append(v)
             else:
-                res[vals[0]] = vals[1]
+                res[k] = [old, v]
+        else:
+            res[k] = v
+        i = amp + 1
     return res
 
-SEND_BUFSZ = 128
+def parse_qs(s):
+    if not s:
+        return {}
+    return _parse_qs_bytes(s.encode())
+
+# An idle keep-alive connection is closed after this many seconds, and
+# any connection after this many requests, so clients can't hold on to
+# sockets which are scarce on small boards
+KEEPALIVE_TIMEOUT = 5
+KEEPALIVE_MAX = 10
+
+# One TCP MSS. The buffer is shared by all connections: asyncio's
+# StreamWriter copies whatever it can't send immediately, so the buffer
+# is free again once awrite() has been called.
+SEND_BUFSZ = 1460
+_SEND_BUF = bytearray(SEND_BUFSZ)
+
+# Number of idle HTTPRequest objects kept for reuse
+REQ_POOL_SZ = 8
+# Run gc.collect() every this many connections
+GC_EVERY = 16
+
+# Static files up to this size are kept in memory as a complete response
+# after the first request for them, up to STATIC_CACHE_MAX bytes of file
+# data in total per app. 0 disables the cache. The defaults are meant for
+# the smallest boards; raise them where there's heap to spare.
+STATIC_CACHE_SZ = 1024
+STATIC_CACHE_MAX = 4096
+
+_MIME = {
+    "html": b"text/html",
+    "htm": b"text/html",
+    "css": b"text/css",
+    "png": b"image/png",
+    "jpg": b"image/jpeg",
+    "jpeg": b"image/jpeg",
+    "js": b"application/javascript",
+    "svg": b"image/svg+xml",
+    "json": b"application/json",
+}
 
 def get_mime_type(fname):
-    if fname.endswith(".html"):
-        return "text/html"
-    if fname.endswith(".css"):
-        return "text/css"
-    if fname.endswith(".png") or fname.endswith(".jpg"):
-        return "image"
-    return "text/plain"
+    return _MIME.get(fname.rpartition(".")[2].lower(), b"text/plain")
 
 def sendstream(writer, f):
-    buf = bytearray(SEND_BUFSZ)
+    buf = _SEND_BUF
+    mv = memoryview(buf)
     while True:
         l = f.readinto(buf)
         if not l:
             break
-        yield from writer.awrite(buf, 0, l)
+        yield from writer.awrite(mv[:l])
 
 def jsonify(writer, dict):
     import ujson
-    yield from start_response(writer, "application/json")
-    yield from writer.awrite(ujson.dumps(dict))
-
-def start_response(writer, content_type="text/html; charset=utf-8", status="200", headers=None):
-    yield from writer.awrite("HTTP/1.0 %s NA\r\n" % status)
-    yield from writer.awrite("Content-Type: ")
-    yield from writer.awrite(content_type)
-    if not headers:
-        yield from writer.awrite("\r\n\r\n")
-        return
-    yield from writer.awrite("\r\n")
-    if isinstance(headers, bytes) or isinstance(headers, str):
-        yield from writer.awrite(headers)
-    else:
-        for k, v in headers.items():
-            yield from writer.awrite(k)
-            yield from writer.awrite(": ")
-            yield from writer.awrite(v)
-            yield from writer.awrite("\r\n")
-    yield from writer.awrite("\r\n")
+    body = ujson.dumps(dict).encode()
+    yield from writer.awrite(b"HTTP/1.1 200 NA\r\nContent-Type: application/json\r\nContent-Length: "
+        + str(len(body)).encode() + b"\r\n\r\n" + body)
+    return True
+
+_STATUS_200 = b"HTTP/1.1 200 NA\r\nContent-Type: text/html; charset=utf-8\r\n\r\n"
+
+def _enc(s):
+    if isinstance(s, (bytes, bytearray)):
+        return s
+    # str, or e.g. an int status code
+    return str(s).encode()
+
+def _error_response(status):
+    # Complete error response, with the status code as the body
+    status = _enc(status)
+    return (b"HTTP/1.1 " + status
+        + b" NA\r\nContent-Type: text/html; charset=utf-8\r\nContent-Length: "
+        + str(len(status) + 2).encode() + b"\r\n\r\n" + status + b"\r\n")
+
+_RESP_404 = _error_response(b"404")
+_RESP_403 = _error_response(b"403")
+
+def _response_head(content_type, status, headers):
+    buf = bytearray(b"HTTP/1.1 ")
+    buf += _enc(status)
+    buf += b" NA\r\nContent-Type: "
+    buf += _enc(content_type)
+    buf += b"\r\n"
+    if headers:
+        if isinstance(headers, bytes) or isinstance(headers, str):
+            buf += _enc(headers)
+        else:
+            for k, v in headers.items():
+                buf += _enc(k)
+                buf += b": "
+                buf += _enc(v)
+                buf += b"\r\n"
+    buf += b"\r\n"
+    return buf
+
+# start_response() and http_error() make a single write, so rather than
+# being generators themselves they return the writer's awrite() coroutine
+# for the caller to "yield from" directly.
+
+def start_response(writer, content_type=b"text/html; charset=utf-8", status=b"200", headers=None):
+    if not headers and status == b"200" and content_type == b"text/html; charset=utf-8":
+        return writer.awrite(_STATUS_200)
+    return writer.awrite(_response_head(content_type, status, headers))
 
 def http_error(writer, status):
-    yield from start_response(writer, status=status)
-    yield from writer.awrite(status)
+    status = _enc(status)
+    if status == b"404":
+        return writer.awrite(_RESP_404)
+    if status == b"403":
+        return writer.awrite(_RESP_403)
+    return writer.awrite(_error_response(status))
+
+_WS = (0x20, 0x09, 0x0d, 0x0a)
+
+# Header names are stored lowercased; common ones map to a single shared
+# bytes object instead of a fresh one per request.
+_KNOWN = {}
+for _k in (b"host", b"content-length", b"content-type", b"connection",
+        b"accept", b"accept-encoding", b"accept-language", b"user-agent",
+        b"authorization", b"cookie", b"referer", b"cache-control"):
+    _KNOWN[_k] = _k
+del _k
+
+def parse_headers(reader):
+    headers = {}
+    while True:
+        l = yield from reader.readline()
+        if not l or l == b"\r\n":
+            break
+        i = l.find(b":")
+        if i < 0:
+            continue
+        # Trim the value in place by index, so only one slice is made
+        j = i + 1
+        end = len(l)
+        while j < end and l[j] in _WS:
+            j += 1
+        while end > j and l[end - 1] in _WS:
+            end -= 1
+        k = l[:i].lower()
+        headers[_KNOWN.get(k, k)] = l[j:end]
+    return headers
+
+def _skip_headers(reader):
+    # Returns whether another request may follow on the connection, i.e.
+    # there's no request body and no "Connection: close". Only lines with
+    # a name as long as one of those headers are looked at closer.
+    reuse = True
+    while True:
+        l = yield from reader.readline()
+        if not l or l == b"\r\n":
+            break
+        i = l.find(b":")
+        if i == 14 or i == 10 or i == 17:
+            k = l[:i].lower()
+            if k == b"content-length":
+                if l[i + 1:].strip() != b"0":
+                    reuse = False
+            elif k == b"connection":
+                if b"close" in l.lower():
+                    reuse = False
+            elif k == b"transfer-encoding":
+                reuse = False
+    return reuse
+
+def _can_reuse(headers, body_read):
+    # Same as what _skip_headers() returns, for parsed headers; a body
+    # read by read_form_data() is no obstacle
+    if b"transfer-encoding" in headers:
+        return False
+    if b"close" in headers.get(b"connection", b"").lower():
+        return False
+    return body_read or headers.get(b"content-length", b"0") == b"0"
+
+def _match_mount(path, mounts):
+    # First (i.e. longest) mount URL which is a prefix of path ending at a
+    # segment boundary
+    if mounts:
+        for app in mounts:
+            root = app.url
+            n = len(root)
+            if path.startswith(root) and (len(path) == n or path[n] == "/" or root.endswith("/")):
+                return app
+    return None
 
 class HTTPRequest:
 
+    # Set while headers are still unread in "lazy" mode
+    _lazy = False
+    # Set once read_form_data() has consumed the request body
+    _body_read = False
+    headers = None
+    form = None
+    url_match = None
+
     def __init__(self):
         pass
 
+    def _reset(self):
+        # Forget everything set on the instance, including attributes a
+        # handler added, so nothing leaks into another client's request.
+        # On MicroPython __dict__ is a read-only copy, hence delattr().
+        for k in list(self.__dict__):
+            delattr(self, k)
+
+    def parse_headers(self):
+        if self._lazy:
+            self._lazy = False
+            self.headers = yield from self.app.parse_headers(self.reader)
+        return self.headers
+
     def read_form_data(self):
-        size = int(self.headers[b"Content-Length"])
+        headers = yield from self.parse_headers()
+        size = int(headers[b"content-length"])
         data = yield from self.reader.readexactly(size)
-        form = parse_qs(data.decode())
-        self.form = form
+        self._body_read = True
+        self.form = _parse_qs_bytes(data)
 
     def parse_qs(self):
-        form = parse_qs(self.qs)
-        self.form = form
+        self.form = _parse_qs_bytes(self.qs.encode())
 
 class WebApp:
 
     def __init__(self, pkg, routes=None, serve_static=True):
+        # Exact string routes are looked up by hash, everything else
+        # (precompiled regexes) is scanned in registration order.
+        self._static_map = {}
+        self._regex_map = []
         if routes:
-            self.url_map = routes
-        else:
-            self.url_map = []
+            for e in routes:
+                self._add_route(*e)
+        # Static files are looked for where the regex list reaches this
+        # marker, i.e. after the routes passed here but before any added
+        # later with route() or add_url_rule()
+        if serve_static:
+            self._regex_map.append((None, None, None))
         if pkg and pkg != "__main__":
             self.pkg = pkg.split(".", 1)[0]
         else:
             self.pkg = None
-        if serve_static:
-            self.url_map.append((re.compile("^/(static/.+)"), self.handle_static))
+        self._static_cache = {}
+        self._static_cached = 0
         self.mounts = []
+        # Mounted apps keyed by the first segment of their URL, longest
+        # URL first within a bucket
+        self.mount_map = {}
         self.inited = False
         self.template_loader = None
-        self.headers_mode = "parse"
+        self.headers_mode = "lazy"
+        # Request objects are recycled instead of allocated per request;
+        # only the app actually serving connections ever fills this
+        self._req_pool = []
+        self._conns = 0
 
     def parse_headers(self, reader):
-        headers = {}
-        while True:
-            l = yield from reader.readline()
-            if l == b"\r\n":
-                break
-            k, v = l.split(b":", 1)
-            headers[k] = v.strip()
-        return headers
+        return parse_headers(reader)
 
     def _handle(self, reader, writer):
+        self._conns += 1
+        if not self._conns % GC_EVERY:
+            gc.collect()
         close = True
         req = None
+        n = 0
         try:
-            request_line = yield from reader.readline()
-            if request_line == b"":
-                yield from writer.aclose()
-                return
-            req = HTTPRequest()
-            request_line = request_line.decode()
-            method, path, proto = request_line.split()
-            path = path.split("?", 1)
-            qs = ""
-            if len(path) > 1:
-                qs = path[1]
-            path = path[0]
-
-            app = self
             while True:
-                found = False
-                for subapp in app.mounts:
-                    root = subapp.url
-                    if path[:len(root)] == root:
-                        app = subapp
-                        found = True
-                        path = path[len(root):]
-                        if not path.startswith("/"):
-                            path = "/" + path
+                if n:
+                    try:
+                        request_line = yield from asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                    except asyncio.TimeoutError:
                         break
-                if not found:
+                else:
+                    request_line = yield from reader.readline()
+                n += 1
+                if request_line == b"":
                     break
-
-            if not app.inited:
-                app.init()
-
-            found = False
-            for e in app.url_map:
-                pattern = e[0]
-                handler = e[1]
-                extra = {}
-                if len(e) > 2:
-                    extra = e[2]
-                if path == pattern:
-                    found = True
+                sp1 = request_line.find(b" ")
+                sp2 = request_line.find(b" ", sp1 + 1)
+                if sp1 < 0 or sp2 < 0:
                     break
-                elif not isinstance(pattern, str):
-                    m = pattern.match(path)
-                    if m:
-                        req.url_match = m
-                        found = True
+                if req is None:
+                    req = self._req_pool.pop() if self._req_pool else HTTPRequest()
+                method = request_line[:sp1].decode()
+                qmark = request_line.find(b"?", sp1 + 1, sp2)
+                if qmark < 0:
+                    path = request_line[sp1 + 1:sp2].decode()
+                    qs = ""
+                else:
+                    path = request_line[sp1 + 1:qmark].decode()
+                    qs = request_line[qmark + 1:sp2].decode()
+                proto = request_line[sp2 + 1:].rstrip()
+
+                app = self
+                while app.mount_map:
+                    i = path.find("/", 1)
+                    first = path[1:i] if i > 0 else path[1:]
+                    # Apps mounted at the root are filed under ""
+                    subapp = (_match_mount(path, app.mount_map.get(first))
+                        or _match_mount(path, app.mount_map.get("")))
+                    if subapp is None:
                         break
+                    app = subapp
+                    path = path[len(subapp.url):]
+                    if not path.startswith("/"):
+                        path = "/" + path
 
-            if not found:
-                headers_mode = "skip"
-            else:
-                headers_mode = extra.get("headers", self.headers_mode)
+                if not app.inited:
+                    app.init()
 
-            if headers_mode == "skip":
-                while True:
-                    l = yield from reader.readline()
-                    if l == b"\r\n":
-                        break
-            elif headers_mode == "parse":
-                req.headers = yield from self.parse_headers(reader)
-            else:
-                assert headers_mode == "leave"
-
-            if found:
-                req.method = method
-                req.path = path
-                req.qs = qs
-                req.reader = reader
-                close = yield from handler(req, writer)
-            else:
-                yield from start_response(writer, status="404")
-                yield from writer.awrite("404\r\n")
+                found = False
+                static = None
+                hit = app._static_map.get(path)
+                if hit:
+                    handler, headers_mode = hit
+                    found = True
+                else:
+                    for pattern, handler, headers_mode in app._regex_map:
+                        if pattern is None:
+                            if path.startswith("/static/") and len(path) > 8:
+                                static = path[1:]
+                                break
+                            continue
+                        m = pattern.match(path)
+                        if m:
+                            req.url_match = m
+                            found = True
+                            break
+
+                if not found:
+                    headers_mode = "skip"
+                elif not headers_mode:
+                    headers_mode = self.headers_mode
+
+                # Whether the connection can carry another request, as far
+                # as the request itself is concerned
+                reuse = False
+                if headers_mode == "skip":
+                    reuse = yield from _skip_headers(reader)
+                elif headers_mode == "parse":
+                    req.headers = yield from self.parse_headers(reader)
+                elif headers_mode == "lazy":
+                    req._lazy = True
+                else:
+                    assert headers_mode == "leave"
+
+                if found:
+                    req.method = method
+                    req.path = path
+                    req.qs = qs
+                    req.reader = reader
+                    req.app = self
+                    close = yield from handler(req, writer)
+                elif static:
+                    close = yield from app.handle_static(req, writer, static)
+                else:
+                    yield from writer.awrite(_RESP_404)
+                    close = True
+
+                # Headers the handler didn't ask for are still read off even
+                # if the connection is closed: closing a socket with unread
+                # data makes the TCP stack send RST, which can lose the
+                # response on the client side.
+                if req._lazy:
+                    reuse = yield from _skip_headers(reader)
+                elif req.headers is not None:
+                    reuse = _can_reuse(req.headers, req._body_read)
+
+                # A handler returning True has sent a length-delimited
+                # response, so an HTTP/1.1 client can send its next request
+                # on the same connection, unless this request had a body left
+                # unread or asked to close. Headers in "leave" mode are the
+                # handler's business, so the connection is closed then.
+                if close is not True or proto != b"HTTP/1.1" or not reuse or n >= KEEPALIVE_MAX:
+                    break
+                req._reset()
         except Exception as e:
             yield from self.handle_exc(req, writer, e)
 
+        # A handler returning False keeps the connection, and may keep
+        # using req too, so it isn't recycled then.
         if close is not False:
+            if req is not None:
+                req._reset()
+                if len(self._req_pool) < REQ_POOL_SZ:
+                    self._req_pool.append(req)
             yield from writer.aclose()
 
     def handle_exc(self, req, resp, e):
@@ -213,16 +493,29 @@ class WebApp:
     def mount(self, url, app):
         app.url = url
         self.mounts.append(app)
-        self.mounts.sort(key=lambda app: len(app.url), reverse=True)
+        mounts = self.mount_map.setdefault(url.strip("/").split("/", 1)[0], [])
+        mounts.append(app)
+        mounts.sort(key=lambda app: len(app.url), reverse=True)
+
+    def _add_route(self, url, func, kwargs=None):
+        # Only the header mode is needed per request; None means the
+        # app default, looked up at request time so it can still change.
+        hm = kwargs.get("headers") if kwargs else None
+        if isinstance(url, str):
+            if not url.startswith("^"):
+                self._static_map[url] = (func, hm)
+                return
+            url = re.compile(url)
+        self._regex_map.append((url, func, hm))
 
     def route(self, url, **kwargs):
         def _route(f):
-            self.url_map.append((url, f, kwargs))
+            self._add_route(url, f, kwargs)
             return f
         return _route
 
     def add_url_rule(self, url, func, **kwargs):
-        self.url_map.append((url, func, kwargs))
+        self._add_route(url, func, kwargs)
 
     def _load_template(self, tmpl_name):
         if self.template_loader is None:
@@ -244,20 +537,63 @@ class WebApp:
             content_type = get_mime_type(fname)
         try:
             with pkg_resources.resource_stream(self.pkg, fname) as f:
-                yield from start_response(writer, content_type, "200", headers)
+                yield from start_response(writer, content_type, b"200", headers)
                 yield from sendstream(writer, f)
         except OSError as e:
-            if e.args[0] == uerrno.ENOENT:
-                yield from http_error(writer, "404")
+            if e.args[0] == errno.ENOENT:
+                yield from http_error(writer, b"404")
             else:
                 raise
 
-    def handle_static(self, req, resp):
-        path = req.url_match.group(1)
-        print(path)
+    def _cache_static(self, path):
+        # Files which are too big, or don't fit any more, are marked with
+        # False so they're streamed without checking again
+        data = False
+        try:
+            with pkg_resources.resource_stream(self.pkg, path) as f:
+                size = f.seek(0, 2)
+                if size <= STATIC_CACHE_SZ and self._static_cached + size <= STATIC_CACHE_MAX:
+                    f.seek(0)
+                    head = _response_head(get_mime_type(path), b"200",
+                        b"Content-Length: " + str(size).encode() + b"\r\n")
+                    # Head and body go into one buffer, which the file is
+                    # read into directly
+                    n = len(head)
+                    data = bytearray(n + size)
+                    data[:n] = head
+                    mv = memoryview(data)
+                    while n < len(data):
+                        l = f.readinto(mv[n:])
+                        if not l:
+                            break
+                        n += l
+                    if n < len(data):
+                        # File changed under us, don't cache it
+                        return None
+                    self._static_cached += size
+        except MemoryError:
+            # Remembered as not cacheable, rather than trying again on
+            # every request
+            data = False
+        except OSError:
+            # Not cached, sendfile() reports the error
+            return None
+        self._static_cache[path] = data
+        return data
+
+    def handle_static(self, req, resp, path):
         if ".." in path:
-            yield from http_error(resp, "403")
+            yield from http_error(resp, b"403")
             return
+        data = self._static_cache.get(path)
+        # Only canonical paths are cached, so one file can't be stored
+        # again under "static/./x", "static//x" and so on
+        if (data is None and STATIC_CACHE_SZ and "//" not in path
+                and "/./" not in path and not path.endswith("/.")):
+            data = self._cache_static(path)
+        if data:
+            yield from resp.awrite(data)
+            return True
         yield from self.sendfile(resp, path)
 
     def init(self):